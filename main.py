@@ -1,254 +1,576 @@
-from flask import Flask, render_template, request, jsonify
-import requests
-import json
+from quart import Quart, Response, render_template, request
+import asyncio
+import gzip
+import hashlib
+import httpx
+import msgspec
+import orjson
 import os
+import queue
 import sqlite3
+import threading
+import time
+import uvicorn
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # --- Configuration ---
 LM_STUDIO_API_URL = os.environ.get("LM_STUDIO_URL", "http://localhost:1234/v1/chat/completions") # Use environment variable for LM Studio URL
 MODEL_NAME = "your-model-name" # Replace with your model name, or also make it an environment variable if needed
 SYSTEM_PROMPT = "You are a helpful AI assistant." # Optional system prompt
 DEBUG = os.environ.get("DEBUG", "False").lower() == "true" # Use environment variable for debug mode
+PORT = int(os.environ.get("PORT", "5000"))
+WORKERS = int(os.environ.get("WORKERS", "1")) # Server processes; caches and LM_CONCURRENCY apply per worker
+app.debug = DEBUG # Set here rather than in app.run() so it also applies when served by uvicorn
 DATABASE = 'chatbot.db'
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4")) # Number of pooled SQLite connections per worker
+LM_STUDIO_TIMEOUT = float(os.environ.get("LM_STUDIO_TIMEOUT", "3000")) or None # Seconds to wait for data from LM Studio, 0 waits forever
+MAX_TURNS = int(os.environ.get("MAX_TURNS", "20")) # Most recent messages sent to LM Studio per request, 0 sends the whole history
+LM_CONCURRENCY = int(os.environ.get("LM_CONCURRENCY", "2")) # Max generations in flight at once, match to what the model can serve
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "256")) # Max conversations kept decoded in memory, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "4096")) # Max cached LM Studio replies, 0 disables the cache
+
+# Built once and prepended to every LM Studio request, so the prompt prefix is identical (and hashes identically) each time
+SYSTEM_MSG = ({"role": "system", "content": SYSTEM_PROMPT},) if SYSTEM_PROMPT else ()
+
+# Shared async HTTP client so connections to LM Studio are pooled and reused across requests
+CLIENT = httpx.AsyncClient(
+    timeout=httpx.Timeout(LM_STUDIO_TIMEOUT, connect=5.0), # Streamed replies reset the read timeout on every chunk, fail fast if LM Studio is down
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    headers={"Content-Type": "application/json"} # Request bodies are pre-encoded with orjson
+)
+# Excess requests wait here instead of queuing inside LM Studio, which slows every generation and can return empty replies
+LM_SEM = asyncio.Semaphore(LM_CONCURRENCY)
+
+# --- SQL Statements ---
+# Shared constants so each statement's text is identical at every call site and hits sqlite3's prepared statement cache
+SQL_HISTORY_LENGTH = "SELECT (SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE conversation_id = c.id) FROM conversations c WHERE c.id = ?"
+SQL_GET_HISTORY = "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY seq"
+SQL_APPEND_MSG = "INSERT INTO messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)"
+SQL_CREATE = "INSERT INTO conversations (name) VALUES (?)"
+SQL_LIST = "SELECT id, name FROM conversations ORDER BY id"
+SQL_RENAME = "UPDATE conversations SET name = ? WHERE id = ?"
+SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE conversation_id = ?"
+SQL_DELETE = "DELETE FROM conversations WHERE id = ?"
 
 # --- Database Functions ---
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
+def _open_connection():
+    """Open a SQLite connection tuned for many short reads/writes from one long-lived process."""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None, # Autocommit, connection is shared via the pool
+                           cached_statements=256) # Keep prepared statements hot across requests
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+    conn.execute("PRAGMA synchronous=NORMAL") # No fsync per commit in WAL mode
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456") # 256 MB
+    conn.execute("PRAGMA cache_size=-65536") # 64 MB
     return conn
 
+# Bounded pool of reusable connections, opened lazily on first use (None marks a free, unopened slot)
+_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+for _ in range(DB_POOL_SIZE):
+    _POOL.put(None)
+
+@contextmanager
+def get_db_connection():
+    """Borrow a connection from the pool and return it when the block exits."""
+    conn = _POOL.get()
+    try:
+        if conn is None:
+            conn = _open_connection()
+        yield conn
+    finally:
+        _POOL.put(conn)
+
+def _migrate_legacy_messages(db):
+    """Move transcripts from the old JSON `conversations.messages` column into the `messages` table."""
+    columns = [row['name'] for row in db.execute("PRAGMA table_info(conversations)")]
+    if 'messages' not in columns:
+        return
+    db.execute("BEGIN")
+    with db: # Commit on success, roll back on error
+        db.execute("""
+            INSERT OR IGNORE INTO messages (conversation_id, seq, role, content)
+            SELECT c.id, j.key, json_extract(j.value, '$.role'), json_extract(j.value, '$.content')
+            FROM conversations c, json_each(c.messages) j
+        """)
+        db.execute("ALTER TABLE conversations DROP COLUMN messages")
+    print("Migrated conversation messages to the messages table.")
+
 def init_db():
     """Initialize the database schema if it doesn't exist."""
-    with app.app_context():
-        db = get_db_connection()
+    with get_db_connection() as db:
         with open('schema.sql', 'r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
-        db.close()
-        print("Database initialized.")
+            db.executescript(f.read())
+        _migrate_legacy_messages(db)
+        # Drop rows left behind by conversations deleted while a reply was still being saved
+        db.execute("DELETE FROM messages WHERE conversation_id NOT IN (SELECT id FROM conversations)")
+    print("Database initialized.")
+
+# Recently used conversation histories (conversation_id -> messages), in LRU order
+_HISTORY_CACHE = OrderedDict()
+_HISTORY_CACHE_LOCK = threading.RLock() # Appends run in worker threads
+
+def _cache_history(conversation_id, messages):
+    """Store a conversation's history, evicting the least recently used one when the cache is full."""
+    if HISTORY_CACHE_SIZE <= 0:
+        return
+    with _HISTORY_CACHE_LOCK:
+        _HISTORY_CACHE[conversation_id] = messages
+        _HISTORY_CACHE.move_to_end(conversation_id)
+        if len(_HISTORY_CACHE) > HISTORY_CACHE_SIZE:
+            _HISTORY_CACHE.popitem(last=False)
 
 def get_conversation_history_db(conversation_id):
     """Fetch conversation history from the database."""
-    db = get_db_connection()
     try:
-        conversation_data = db.execute("SELECT messages FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
-        db.close()
-        if conversation_data:
-            return json.loads(conversation_data['messages'])
-        else:
-            return None
+        with get_db_connection() as db:
+            row = db.execute(SQL_HISTORY_LENGTH, (conversation_id,)).fetchone()
+            if row is None:
+                with _HISTORY_CACHE_LOCK:
+                    _HISTORY_CACHE.pop(conversation_id, None)
+                return None
+            # The cached copy is only trusted if no other worker has appended to the conversation since
+            with _HISTORY_CACHE_LOCK:
+                cached_history = _HISTORY_CACHE.get(conversation_id)
+                if cached_history is not None and len(cached_history) == row[0]:
+                    _HISTORY_CACHE.move_to_end(conversation_id)
+                    return list(cached_history) # Callers append to the list they get back
+            rows = db.execute(SQL_GET_HISTORY, (conversation_id,)).fetchall()
+        history = [{"role": row['role'], "content": row['content']} for row in rows]
+        _cache_history(conversation_id, history)
+        return list(history)
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return None
 
-def update_conversation_db(conversation_id, messages):
-    """Update the conversation messages in the database."""
-    db = get_db_connection()
+def append_messages_db(conversation_id, messages):
+    """Append new messages to the end of a conversation in a single transaction."""
     try:
-        db.execute("UPDATE conversations SET messages = ? WHERE id = ?", (json.dumps(messages), conversation_id)) # Save messages as JSON string
-        db.commit()
-        db.close()
+        with get_db_connection() as db:
+            db.execute("BEGIN IMMEDIATE") # Take the write lock up front so the next seq can't race
+            with db:
+                row = db.execute(SQL_HISTORY_LENGTH, (conversation_id,)).fetchone()
+                if row is None: # Conversation was deleted while its reply was being generated
+                    with _HISTORY_CACHE_LOCK:
+                        _HISTORY_CACHE.pop(conversation_id, None)
+                    return False
+                next_seq = row[0]
+                db.executemany(SQL_APPEND_MSG,
+                               [(conversation_id, next_seq + offset, message['role'], message['content']) for offset, message in enumerate(messages)])
+        # Extend the cached history in place of re-reading it on the next turn
+        with _HISTORY_CACHE_LOCK:
+            cached_history = [] if next_seq == 0 else _HISTORY_CACHE.get(conversation_id)
+            if cached_history is not None and len(cached_history) == next_seq:
+                _cache_history(conversation_id, cached_history + list(messages))
         return True
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return False
 
 def create_conversation_db():
     """Create a new conversation entry in the database and return its ID."""
-    db = get_db_connection()
     try:
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO conversations (name, messages) VALUES (?, ?)", ('New Conversation', json.dumps([]))) # Initial conversation with empty messages
-        conversation_id = cursor.lastrowid
-        db.commit()
-        db.close()
-        return conversation_id
+        with get_db_connection() as db:
+            cursor = db.execute(SQL_CREATE, ('New Conversation',))
+        _invalidate_conversation_list()
+        return cursor.lastrowid
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return None
 
+# Recently fetched conversation list, so page loads and /history polls don't each rerun the query
+LIST_CACHE_TTL = 1.0 # Seconds
+_LIST_CACHE = {"value": None, "stamp": 0.0, "generation": 0} # Generation is bumped by every invalidation
+_LIST_CACHE_LOCK = threading.Lock() # Reads and invalidations run in worker threads
+
+def _invalidate_conversation_list():
+    """Force the next get_conversation_list_db() call to hit the database."""
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE["generation"] += 1
+        _LIST_CACHE["stamp"] = 0.0
+
 def get_conversation_list_db():
     """Fetch a list of conversations (IDs and names) from the database."""
-    db = get_db_connection()
+    with _LIST_CACHE_LOCK:
+        if _LIST_CACHE["value"] is not None and time.monotonic() - _LIST_CACHE["stamp"] < LIST_CACHE_TTL:
+            return _LIST_CACHE["value"]
+        generation = _LIST_CACHE["generation"]
     try:
-        conversations = db.execute("SELECT id, name FROM conversations").fetchall()
-        db.close()
-        return [{"id": row['id'], "name": row['name']} for row in conversations]
+        with get_db_connection() as db:
+            cursor = db.cursor()
+            cursor.row_factory = None # Plain tuples, no sqlite3.Row allocated per conversation
+            conversations = [{"id": conversation_id, "name": name} for conversation_id, name in cursor.execute(SQL_LIST)]
+        with _LIST_CACHE_LOCK:
+            if _LIST_CACHE["generation"] == generation: # A write committed during the query may not be in this result
+                _LIST_CACHE["value"] = conversations
+                _LIST_CACHE["stamp"] = time.monotonic()
+        return conversations
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return []
 
 def rename_conversation_db(conversation_id, new_name):
     """Rename a conversation in the database."""
-    db = get_db_connection()
     try:
-        db.execute("UPDATE conversations SET name = ? WHERE id = ?", (new_name, conversation_id))
-        db.commit()
-        db.close()
+        with get_db_connection() as db:
+            db.execute(SQL_RENAME, (new_name, conversation_id))
+        _invalidate_conversation_list()
         return True
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return False
 
 def delete_conversation_db(conversation_id):
     """Delete a conversation from the database."""
-    db = get_db_connection()
     try:
-        db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
-        db.commit()
-        db.close()
+        with get_db_connection() as db:
+            db.execute("BEGIN")
+            with db:
+                db.execute(SQL_DELETE_MESSAGES, (conversation_id,))
+                db.execute(SQL_DELETE, (conversation_id,))
+        with _HISTORY_CACHE_LOCK:
+            _HISTORY_CACHE.pop(conversation_id, None)
+        _invalidate_conversation_list()
         return True
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        db.close()
         return False
 
 
 # --- LM Studio Interaction Function ---
-def get_lm_studio_response(messages):
+class LMStudioError(Exception):
+    """Raised when a streamed reply fails; the message is safe to show to the user."""
+
+# Typed views of the chat completion responses; fields not declared here are skipped while decoding
+class LMMessage(msgspec.Struct):
+    content: str = ""
+
+class LMChoice(msgspec.Struct):
+    message: LMMessage
+
+class LMResponse(msgspec.Struct):
+    choices: list[LMChoice] = []
+
+class LMDelta(msgspec.Struct):
+    content: Optional[str] = None
+
+class LMStreamChoice(msgspec.Struct):
+    delta: LMDelta = msgspec.field(default_factory=LMDelta)
+
+class LMStreamChunk(msgspec.Struct):
+    choices: list[LMStreamChoice] = []
+
+_RESPONSE_DECODER = msgspec.json.Decoder(LMResponse)
+_STREAM_CHUNK_DECODER = msgspec.json.Decoder(LMStreamChunk)
+
+_RESPONSE_CACHE = OrderedDict() # Digest of the full message list -> reply, in LRU order
+
+def _response_cache_key(messages):
+    """Hash the full message list so identical prompts map to the same cache entry."""
+    return hashlib.blake2b(orjson.dumps(messages)).digest()
+
+def _cache_response(key, reply):
+    """Store a reply, evicting the least recently used entry when the cache is full."""
+    if RESPONSE_CACHE_SIZE <= 0:
+        return
+    _RESPONSE_CACHE[key] = reply
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        _RESPONSE_CACHE.popitem(last=False)
+
+async def get_lm_studio_response(messages):
     """Send messages to LM Studio API and get the response."""
+    cache_key = _response_cache_key(messages)
+    cached_reply = _RESPONSE_CACHE.get(cache_key)
+    if cached_reply is not None:
+        _RESPONSE_CACHE.move_to_end(cache_key)
+        return cached_reply
+
     try:
         payload = {
             "messages": messages,
             "model": MODEL_NAME,
             "stream": False # Set to True if you want streaming
         }
-        headers = {
-            "Content-Type": "application/json"
-        }
 
-        response = requests.post(LM_STUDIO_API_URL, headers=headers, json=payload, timeout=3000) # Timeout for robustness
+        async with LM_SEM:
+            response = await CLIENT.post(LM_STUDIO_API_URL, content=orjson.dumps(payload)) # Timeouts are configured on CLIENT
         response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
 
-        response_json = response.json()
+        parsed = _RESPONSE_DECODER.decode(response.content)
 
-        if 'choices' in response_json and response_json['choices']:
-            reply = response_json['choices'][0]['message']['content']
-            return reply.strip()
+        if parsed.choices:
+            reply = parsed.choices[0].message.content.strip()
+            _cache_response(cache_key, reply) # Only successful replies are cached
+            return reply
         else:
-            print(f"Unexpected LM Studio response format: {response_json}") # Log unexpected response
+            print(f"Unexpected LM Studio response format: {response.text}") # Log unexpected response
             return "Sorry, I couldn't generate a response."
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error communicating with LM Studio API: {e}") # Log request errors
         return "Failed to get response from AI model."
-    except json.JSONDecodeError as e:
+    except msgspec.DecodeError as e:
         print(f"Error decoding JSON response from LM Studio API: {e}, Response text: {response.text if 'response' in locals() else 'No response'}") # Log JSON decode errors
         return "Error processing AI response."
 
+async def stream_lm_studio_response(messages):
+    """Send messages to LM Studio API and yield the response text as it is generated.
+
+    Raises LMStudioError if the request fails or the model returns nothing.
+    """
+    cache_key = _response_cache_key(messages)
+    cached_reply = _RESPONSE_CACHE.get(cache_key)
+    if cached_reply is not None:
+        _RESPONSE_CACHE.move_to_end(cache_key)
+        yield cached_reply
+        return
+
+    payload = {
+        "messages": messages,
+        "model": MODEL_NAME,
+        "stream": True
+    }
+    reply_parts = []
+    try:
+        async with LM_SEM: # Held for the whole stream, the model is busy until it finishes
+            async with CLIENT.stream("POST", LM_STUDIO_API_URL, content=orjson.dumps(payload)) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines(): # Server-sent events, one "data: {...}" line per chunk
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = line[len("data:"):].strip()
+                    if chunk == "[DONE]":
+                        break
+                    choices = _STREAM_CHUNK_DECODER.decode(chunk).choices
+                    delta = choices[0].delta.content if choices else None
+                    if delta:
+                        reply_parts.append(delta)
+                        yield delta
+
+    except httpx.HTTPError as e:
+        print(f"Error communicating with LM Studio API: {e}") # Log request errors
+        raise LMStudioError("Failed to get response from AI model.") from e
+    except msgspec.DecodeError as e:
+        print(f"Error decoding streamed JSON from LM Studio API: {e}") # Log JSON decode errors
+        raise LMStudioError("Error processing AI response.") from e
+
+    if reply_parts:
+        _cache_response(cache_key, ''.join(reply_parts).strip()) # Only complete replies are cached
+    else:
+        print("LM Studio stream ended without any content.") # Log unexpected response
+        raise LMStudioError("Sorry, I couldn't generate a response.")
+
+def _recent_history(history):
+    """Return the last MAX_TURNS messages, dropping leading replies so the window starts on a user turn."""
+    if MAX_TURNS <= 0:
+        return history
+    start = max(len(history) - MAX_TURNS, 0)
+    while start < len(history) - 1 and history[start]['role'] != 'user': # Many chat templates reject a leading assistant turn
+        start += 1
+    return history[start:]
+
+
+# --- Response Helpers ---
+def json_response(data):
+    """Build a JSON response, encoded with orjson."""
+    return app.response_class(orjson.dumps(data), mimetype='application/json')
+
+def _sse_event(data):
+    """Encode a payload as a server-sent event."""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+_PENDING_WRITES = {} # conversation_id -> latest background write for it, each chained after the one before
+
+async def _append_after(previous_write, conversation_id, messages):
+    """Append new turns once the previous write for the same conversation has finished."""
+    if previous_write is not None:
+        await asyncio.wait([previous_write]) # Keeps turns in order even if the earlier write failed
+    await asyncio.to_thread(append_messages_db, conversation_id, messages)
+
+def _persist_in_background(conversation_id, messages):
+    """Append new turns from a worker thread without holding up the response."""
+    key = str(conversation_id) # IDs from JSON bodies and URL routes may differ in type
+    task = asyncio.create_task(_append_after(_PENDING_WRITES.get(key), conversation_id, messages))
+    _PENDING_WRITES[key] = task
+
+    def forget(done_task):
+        if _PENDING_WRITES.get(key) is done_task:
+            del _PENDING_WRITES[key]
+    task.add_done_callback(forget)
+
+async def _wait_for_pending_write(conversation_id):
+    """Wait until every background write for a conversation has reached the database."""
+    task = _PENDING_WRITES.get(str(conversation_id))
+    if task is not None:
+        await asyncio.wait([task])
+
+
+# --- Quart Routes ---
+# Database helpers block (SQLite busy waits, pool checkout), so routes always run them via asyncio.to_thread
+@app.after_serving
+async def flush_background_tasks():
+    """Let pending message writes finish before the server shuts down."""
+    if _PENDING_WRITES:
+        await asyncio.wait(list(_PENDING_WRITES.values()))
+
+@app.after_serving
+async def close_client():
+    """Close the shared HTTP client when the server shuts down."""
+    await CLIENT.aclose()
+
+_INDEX_CACHE = {} # Rendered index page, plain and gzip-compressed, filled on first request
 
-# --- Flask Routes ---
 @app.route('/')
-def index():
-    """Serve the main HTML page, passing conversation history."""
-    conversations = get_conversation_list_db()
-    return render_template('index.html', conversations=conversations) # Pass conversations to template
+async def index():
+    """Serve the main HTML page; the page loads the conversation list from /history."""
+    if DEBUG or not _INDEX_CACHE: # Re-render every time in debug mode so template edits show up
+        html = (await render_template('index.html')).encode()
+        _INDEX_CACHE["html"] = html
+        _INDEX_CACHE["gzip"] = gzip.compress(html, compresslevel=9)
+    if request.accept_encodings['gzip'] > 0: # Quality 0 means the client refuses gzip
+        return Response(_INDEX_CACHE["gzip"], mimetype='text/html', headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return Response(_INDEX_CACHE["html"], mimetype='text/html', headers={"Vary": "Accept-Encoding"})
 
 @app.route('/chat', methods=['POST'])
-def chat():
-    """Endpoint to handle chatbot messages."""
-    data = request.get_json()
+async def chat():
+    """Endpoint to handle chatbot messages.
+
+    Returns the full reply as JSON, or streams it as server-sent events when the request sets "stream": true.
+    """
+    data = await request.get_json()
     message = data.get('message')
     conversation_id = data.get('conversation_id')
+    stream = data.get('stream', False)
 
     if not message:
-        return jsonify({"error": "Message content is missing."}), 400
+        return json_response({"error": "Message content is missing."}), 400
 
     conversation_history = []
     if conversation_id:
-        conversation_history = get_conversation_history_db(conversation_id)
+        await _wait_for_pending_write(conversation_id) # The previous turn may still be on its way to the database
+        conversation_history = await asyncio.to_thread(get_conversation_history_db, conversation_id)
         if conversation_history is None:
-            return jsonify({"error": "Invalid conversation ID."}), 400
+            return json_response({"error": "Invalid conversation ID."}), 400
+    elif stream:
+        conversation_id = await asyncio.to_thread(create_conversation_db) # The stream announces the new conversation's ID before any reply text
+        if not conversation_id:
+            return json_response({"error": "Failed to create new conversation."}), 500
 
     # Append user message to conversation history
     conversation_history.append({"role": "user", "content": message})
 
 
-    # Prepare messages for LM Studio API, include system prompt and conversation history
-    lm_studio_messages = []
-    if SYSTEM_PROMPT:
-        lm_studio_messages.append({"role": "system", "content": SYSTEM_PROMPT})
-    lm_studio_messages.extend(conversation_history)
+    # Prepare messages for LM Studio API, include system prompt and the recent part of the conversation history
+    lm_studio_messages = [*SYSTEM_MSG, *_recent_history(conversation_history)]
 
 
-    # Get response from LM Studio
-    reply_text = get_lm_studio_response(lm_studio_messages)
+    if stream:
+        async def stream_reply():
+            reply_parts = []
+            error = None
+            try:
+                yield _sse_event({"conversation_id": conversation_id})
+                async for delta in stream_lm_studio_response(lm_studio_messages):
+                    reply_parts.append(delta)
+                    yield _sse_event({"delta": delta})
+            except LMStudioError as e:
+                error = str(e)
+            finally:
+                # Persist whatever was generated, even if the client disconnected mid-stream; error text is never saved
+                reply_text = ''.join(reply_parts).strip()
+                if reply_text:
+                    conversation_history.append({"role": "assistant", "content": reply_text})
+                    _persist_in_background(conversation_id, conversation_history[-2:])
+            # Sent after the write is queued, so a follow-up request will wait for it
+            yield _sse_event({"error": error} if error else {"done": True})
 
-    # Append bot response to conversation history
-    conversation_history.append({"role": "assistant", "content": reply_text})
+        response = Response(stream_reply(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+        response.timeout = None # Generations can outlast Quart's default response timeout
+        return response
 
 
+    # Get response from LM Studio
     if conversation_id:
-        update_conversation_db(conversation_id, conversation_history) # Update existing conversation
+        reply_text = await get_lm_studio_response(lm_studio_messages)
     else:
-        conversation_id = create_conversation_db() # Create new conversation if no ID was provided
-        if conversation_id:
-            update_conversation_db(conversation_id, conversation_history) # Save initial turn for new conversation
-        else:
-            return jsonify({"error": "Failed to create new conversation."}), 500
+        # Create new conversation while LM Studio is already working on the reply
+        conversation_id, reply_text = await asyncio.gather(
+            asyncio.to_thread(create_conversation_db),
+            get_lm_studio_response(lm_studio_messages)
+        )
+        if not conversation_id:
+            return json_response({"error": "Failed to create new conversation."}), 500
+
+    # Append bot response to conversation history
+    conversation_history.append({"role": "assistant", "content": reply_text})
+
+    # Only the new user/assistant turns are written, earlier history is already stored; the reply doesn't wait for the write
+    _persist_in_background(conversation_id, conversation_history[-2:])
 
-    return jsonify({"reply": reply_text, "conversation_id": conversation_id})
+    return json_response({"reply": reply_text, "conversation_id": conversation_id})
 
 
 @app.route('/history', methods=['GET'])
-def history():
+async def history():
     """API endpoint to get the list of conversations."""
-    conversation_list = get_conversation_list_db()
-    return jsonify(conversation_list)
+    conversation_list = await asyncio.to_thread(get_conversation_list_db)
+    return json_response(conversation_list)
 
 @app.route('/history/<int:conversation_id>', methods=['GET'])
-def get_conversation(conversation_id):
+async def get_conversation(conversation_id):
     """API endpoint to get a specific conversation's history."""
-    history = get_conversation_history_db(conversation_id)
+    await _wait_for_pending_write(conversation_id)
+    history = await asyncio.to_thread(get_conversation_history_db, conversation_id)
     if history is None:
-        return jsonify({"error": "Conversation not found"}), 404
-    return jsonify(history)
+        return json_response({"error": "Conversation not found"}), 404
+    return json_response(history)
 
 @app.route('/history/rename/<int:conversation_id>', methods=['POST'])
-def rename_conversation(conversation_id):
+async def rename_conversation(conversation_id):
     """API endpoint to rename a conversation."""
-    data = request.get_json()
+    data = await request.get_json()
     new_name = data.get('name')
     if not new_name:
-        return jsonify({"error": "New name is required"}), 400
-    if rename_conversation_db(conversation_id, new_name):
-        return jsonify({"message": "Conversation renamed successfully"})
+        return json_response({"error": "New name is required"}), 400
+    if await asyncio.to_thread(rename_conversation_db, conversation_id, new_name):
+        return json_response({"message": "Conversation renamed successfully"})
     else:
-        return jsonify({"error": "Conversation not found"}), 404
+        return json_response({"error": "Conversation not found"}), 404
 
 @app.route('/history/delete/<int:conversation_id>', methods=['DELETE'])
-def delete_conversation(conversation_id):
+async def delete_conversation(conversation_id):
     """API endpoint to delete a conversation."""
-    if delete_conversation_db(conversation_id):
-        return jsonify({"message": "Conversation deleted successfully"})
+    await _wait_for_pending_write(conversation_id) # Otherwise a queued append could land after the delete
+    if await asyncio.to_thread(delete_conversation_db, conversation_id):
+        return json_response({"message": "Conversation deleted successfully"})
     else:
-        return jsonify({"error": "Conversation not found"}), 404
+        return json_response({"error": "Conversation not found"}), 404
 
 @app.route('/history/new', methods=['POST'])
-def new_conversation():
+async def new_conversation():
     """API endpoint to create a new conversation."""
-    conversation_id = create_conversation_db()
+    conversation_id = await asyncio.to_thread(create_conversation_db)
     if conversation_id:
-        return jsonify({"conversation_id": conversation_id})
+        return json_response({"conversation_id": conversation_id})
     else:
-        return jsonify({"error": "Failed to create new conversation."}), 500
+        return json_response({"error": "Failed to create new conversation."}), 500
 
 
 if __name__ == '__main__':
     if not os.path.exists(DATABASE):
         print("Database file not found. Initializing database...")
-        init_db()
     else:
         print("Database file found.")
+    init_db() # Schema is idempotent; also migrates databases created by older versions
 
     print("Server is starting, make sure LM Studio is running and accessible at", LM_STUDIO_API_URL)
     print("Debug mode is:", DEBUG)
 
-    app.run(debug=DEBUG, host='0.0.0.0')
\ No newline at end of file
+    # "auto" picks uvloop and httptools when they are installed (not available on Windows) and falls back to asyncio/h11
+    uvicorn.run("main:app", host='0.0.0.0', port=PORT, workers=WORKERS, loop="auto", http="auto",
+                log_level="debug" if DEBUG else "info")
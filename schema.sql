@@ -1,5 +1,13 @@
 CREATE TABLE IF NOT EXISTS conversations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL DEFAULT 'New Conversation',
-    messages TEXT NOT NULL
-);
\ No newline at end of file
+    name TEXT NOT NULL DEFAULT 'New Conversation'
+);
+
+-- One row per chat turn; the primary key keeps each conversation's turns clustered and ordered
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;